@@ -20,18 +20,24 @@ from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterDefinition
 from qgis.core import QgsProcessingParameterFile
 from qgis.core import QgsProcessingContext
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingParameterEnum
 from qgis.core import QgsProject
 from qgis.core import Qgis
 from qgis.core import QgsVectorLayer
+from qgis.core import QgsPointXY
+from qgis.core import QgsGeometry
+from qgis.core import QgsCoordinateReferenceSystem
+from qgis.core import QgsCoordinateTransform
+from qgis.core import NULL
 import processing
+from osgeo import gdal
+from concurrent.futures import ThreadPoolExecutor
 import time
 import sys
 import os
-import statistics
 import pandas as pd
-from scipy import optimize
-import csv
 import numpy as np
 
 class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
@@ -101,23 +107,19 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
         feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
-        
-        feedback.pushInfo('')
-        feedback.pushInfo('Retrieving of materials data')
-        # Intersection
+
+        # Extraire par localisation, points under buildings are removed before the intersection with the ground layer
         alg_params = {
             'INPUT': outputs['Spatial_index_1']['OUTPUT'],
-            'INPUT_FIELDS': ['id'],
-            'OVERLAY': parameters['grounddescriptionlayer'],
-            'OVERLAY_FIELDS': ['Material','alb','em','Cv','lambd','ep','kc','FixedTemp[degC]'],
-            'OVERLAY_FIELDS_PREFIX': '',
+            'INTERSECT': parameters['buildingslayer'],
+            'PREDICATE': [2],  # est disjoint
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['Intersection'] = processing.run('native:intersection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        outputs['ExtraireParLocalisation'] = processing.run('native:extractbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
 
         # Spatial_index_2
         alg_params = {
-            'INPUT': outputs['Intersection']['OUTPUT']
+            'INPUT': outputs['ExtraireParLocalisation']['OUTPUT']
         }
         if Qgis.QGIS_VERSION_INT>=31600:
             outputs['Spatial_index_2'] = processing.run('native:createspatialindex', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
@@ -127,93 +129,40 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
         feedback.setCurrentStep(2)
         if feedback.isCanceled():
             return {}
-
-        # Extraire par localisation
+        
+        feedback.pushInfo('')
+        feedback.pushInfo('Retrieving of materials data')
+        # Intersection
         alg_params = {
             'INPUT': outputs['Spatial_index_2']['OUTPUT'],
-            'INTERSECT': parameters['buildingslayer'],
-            'PREDICATE': [2],  # est disjoint
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ExtraireParLocalisation'] = processing.run('native:extractbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # Spatial_index_3
-        alg_params = {
-            'INPUT': outputs['ExtraireParLocalisation']['OUTPUT']
-        }
-        if Qgis.QGIS_VERSION_INT>=31600:
-            outputs['Spatial_index_3'] = processing.run('native:createspatialindex', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        else:
-            outputs['Spatial_index_3'] = processing.run('qgis:createspatialindex', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # Compute x
-        alg_params = {
-            'FIELD_LENGTH': 0,
-            'FIELD_NAME': 'x',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 0,  # Flottant
-            'FORMULA': 'x($geometry)',
-            'INPUT': outputs['ExtraireParLocalisation']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        if Qgis.QGIS_VERSION_INT>=31600:
-            outputs['ComputeX'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        else:
-            outputs['ComputeX'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # Compute y
-        alg_params = {
-            'FIELD_LENGTH': 0,
-            'FIELD_NAME': 'y',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 0,  # Flottant
-            'FORMULA': 'y($geometry)',
-            'INPUT': outputs['ComputeX']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        if Qgis.QGIS_VERSION_INT>=31600:
-            outputs['ComputeY'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        else:
-            outputs['ComputeY'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        # Compute Long
-        alg_params = {
-            'FIELD_LENGTH': 0,
-            'FIELD_NAME': 'Long',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 0,  # Flottant
-            'FORMULA': 'x(transform($geometry,\''+SCR+'\',\'EPSG:4326\'))',
-            'INPUT': outputs['ComputeY']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        if Qgis.QGIS_VERSION_INT>=31600:
-            outputs['ComputeLong'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        else:
-            outputs['ComputeLong'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-            
-        # Compute Lat
-        alg_params = {
-            'FIELD_LENGTH': 0,
-            'FIELD_NAME': 'Lat',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 0,  # Flottant
-            'FORMULA': 'y(transform($geometry,\''+SCR+'\',\'EPSG:4326\'))',
-            'INPUT': outputs['ComputeLong']['OUTPUT'],
+            'INPUT_FIELDS': ['id'],
+            'OVERLAY': parameters['grounddescriptionlayer'],
+            'OVERLAY_FIELDS': ['Material','alb','em','Cv','lambd','ep','kc','FixedTemp[degC]'],
+            'OVERLAY_FIELDS_PREFIX': '',
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        if Qgis.QGIS_VERSION_INT>=31600:
-            outputs['ComputeLat'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        else:
-            outputs['ComputeLat'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        outputs['Intersection'] = processing.run('native:intersection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
 
-        # Spatial_index_4
-        alg_params = {
-            'INPUT': outputs['ComputeLat']['OUTPUT']
-        }
-        if Qgis.QGIS_VERSION_INT>=31600:
-            outputs['Spatial_index_4'] = processing.run('native:createspatialindex', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        else:
-            outputs['Spatial_index_4'] = processing.run('qgis:createspatialindex', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Compute x, y, Long and Lat of each point, kept in a table instead of being added to the layer
+        grid_layer=QgsProcessingUtils.mapLayerFromString(outputs['Intersection']['OUTPUT'], context)
+        ids=[]
+        points=[]
+        for feature in grid_layer.getFeatures():
+            ids.append(feature['id'])
+            points.append(QgsPointXY(feature.geometry().vertexAt(0)))
+        # The transform is built once from the processing context and all points are transformed at once as a single multipoint geometry
+        transform_4326=QgsCoordinateTransform(grid_layer.crs(), QgsCoordinateReferenceSystem('EPSG:4326'), context.transformContext())
+        points_4326=QgsGeometry.fromMultiPointXY(points)
+        points_4326.transform(transform_4326)
+        points_4326=points_4326.asMultiPoint()
+        coordinates=pd.DataFrame({
+            'id': ids,
+            'x': np.fromiter((point.x() for point in points), dtype=np.float64, count=len(points)),
+            'y': np.fromiter((point.y() for point in points), dtype=np.float64, count=len(points)),
+            'Long': np.fromiter((point.x() for point in points_4326), dtype=np.float64, count=len(points)),
+            'Lat': np.fromiter((point.y() for point in points_4326), dtype=np.float64, count=len(points))
+        }).drop_duplicates(subset=["id"]).set_index("id")
+        del points, points_4326
         
         feedback.setCurrentStep(3)
         if feedback.isCanceled():
@@ -222,37 +171,81 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
         feedback.pushInfo('')
         feedback.pushInfo('Retrieving shadow information from rasters')
         
-        # Get shadow values for each hour
-        Shadow_h=[]
+        # Read the features of a layer as a dataframe (NULL attributes are read as NaN)
+        def layer_to_dataframe(layer):
+            fields=[field.name() for field in layer.fields()]
+            records=[[None if value==NULL else value for value in feature.attributes()] for feature in layer.getFeatures()]
+            return pd.DataFrame.from_records(records, columns=fields)
+
+        # Points attributes are the same for every hour, they are read once
+        Pts_attributes=layer_to_dataframe(grid_layer)
+        # Material values may be text fields (e.g. joined from a csv without .csvt), they are read as numbers
+        material_columns=['alb','em','Cv','lambd','ep','kc','FixedTemp[degC]']
+        Pts_attributes[material_columns]=Pts_attributes[material_columns].apply(pd.to_numeric)
+
+        # Shadow rasters of each hour
+        Shadow_files={}
         for file in os.scandir(os.path.join(ProjectPath,'Step_3')):
             if (file.path.endswith(".tif")) and 'fraction_on' not in os.path.basename(file.path):
-                h=int(os.path.basename(file.path).split("_")[2][:2])
-                Shadow_h.append(h)
-                
-                # Extract raster values
-                last_saved=os.path.join(ProjectPath,'Step_4','Temp',str(h)+'.csv')
-                alg_params = {
-                    'COLUMN_PREFIX': 'Shadow',
-                    'INPUT': outputs['Spatial_index_4']['OUTPUT'],
-                    'RASTERCOPY': file.path,
-                    'OUTPUT': os.path.join(ProjectPath,'Step_4','Temp',str(h)+'.csv')
-                }
-                if Qgis.QGIS_VERSION_INT>=31600:
-                    outputs['PrleverDesValeursRasters'] = processing.run('native:rastersampling', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-                else:
-                    outputs['PrleverDesValeursRasters'] = processing.run('qgis:rastersampling', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        
-        other_hours=pd.read_csv(last_saved,sep=',')
+                Shadow_files[int(os.path.basename(file.path).split("_")[2][:2])]=file.path
+
+        # Open a shadow raster, an unreadable file stops the algorithm
+        def open_raster(path):
+            dataset=gdal.Open(path)
+            if dataset is None:
+                raise QgsProcessingException('Unable to read shadow raster '+path)
+            return dataset
+
+        # All shadow rasters come from the same DSM, points are moved to the rasters CRS if needed
+        sample_x=coordinates['x'].to_numpy()
+        sample_y=coordinates['y'].to_numpy()
+        raster_crs=QgsCoordinateReferenceSystem.fromWkt(open_raster(next(iter(Shadow_files.values()))).GetProjection()) if Shadow_files else grid_layer.crs()
+        if raster_crs.isValid() and raster_crs!=grid_layer.crs():
+            points_raster=QgsGeometry.fromMultiPointXY([QgsPointXY(x,y) for x,y in zip(sample_x,sample_y)])
+            points_raster.transform(QgsCoordinateTransform(grid_layer.crs(), raster_crs, context.transformContext()))
+            points_raster=points_raster.asMultiPoint()
+            sample_x=np.fromiter((point.x() for point in points_raster), dtype=np.float64, count=len(points_raster))
+            sample_y=np.fromiter((point.y() for point in points_raster), dtype=np.float64, count=len(points_raster))
+            del points_raster
+
+        # Value of the pixel containing each point (NaN outside of the raster or on nodata), each call opens its own dataset
+        # Pixel indices come from the inverse of the full geotransform (rotated rasters included), band scale and offset are applied
+        # Only the window of the raster covering the points is read
+        def sample_raster(path):
+            dataset=open_raster(path)
+            band=dataset.GetRasterBand(1)
+            gt=dataset.GetGeoTransform()
+            det=gt[1]*gt[5]-gt[2]*gt[4]
+            dx=sample_x-gt[0]
+            dy=sample_y-gt[3]
+            col=np.floor((gt[5]*dx-gt[2]*dy)/det).astype(np.int64)
+            row=np.floor((gt[1]*dy-gt[4]*dx)/det).astype(np.int64)
+            inside=(col>=0)&(col<dataset.RasterXSize)&(row>=0)&(row<dataset.RasterYSize)
+            values=np.full(len(sample_x), np.nan, dtype=np.float32)
+            if not inside.any():
+                return values
+            row, col = row[inside], col[inside]
+            xoff, yoff = int(col.min()), int(row.min())
+            window=band.ReadAsArray(xoff, yoff, int(col.max())-xoff+1, int(row.max())-yoff+1)
+            values[inside]=window[row-yoff,col-xoff]
+            nodata=band.GetNoDataValue()
+            if nodata is not None:
+                values[values==nodata]=np.nan
+            return values*(band.GetScale() or 1)+(band.GetOffset() or 0)
+
+        # Get shadow values for each hour, rasters are sampled in parallel, one row per point (in the order of coordinates) and one column per hour
         # Settings shadow during night, 0
-        if Qgis.QGIS_VERSION_INT>=31600:
-            other_hours["Shadow1"]=0
-        else:
-            other_hours["Shadow_1"]=0
-        
-        for h in range(24):
-            if not(h+1 in Shadow_h):
-                # Set shadow to 0 during night
-                other_hours.to_csv(os.path.join(ProjectPath, 'Step_4', 'Temp',str(h+1)+'.csv'),index=False, mode='w', header=True, sep=',')
+        shadow_wide=np.zeros((len(coordinates),24), dtype=np.float32)
+        # A few workers are enough and bound the memory used by the raster windows read at the same time
+        with ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1)) as executor:
+            futures={h: executor.submit(sample_raster, path) for h, path in Shadow_files.items()}
+            for i, (h, future) in enumerate(futures.items()):
+                if feedback.isCanceled():
+                    for pending in futures.values():
+                        pending.cancel()
+                    return {}
+                shadow_wide[:,h-1]=future.result()
+                feedback.setProgress(100*(i+1)/len(futures))
         
         feedback.setCurrentStep(4)
         if feedback.isCanceled():
@@ -260,56 +253,39 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
         
         feedback.pushInfo('')
         feedback.pushInfo('Preparing all data for temperature calculation...')
-        # Group all csv files and save id_list
-        for h in range (24):
-            temp=pd.read_csv(os.path.join(ProjectPath,'Step_4','Temp',str(h+1)+'.csv'),sep=',')
-            temp["hour"]=h+1
-            if h==0:
-                temp.to_csv(os.path.join(ProjectPath, 'Step_4', 'ComputedPoints.csv'),index=False, mode='w', header=True, sep=',')
-            else:
-                id_list=temp["id"].tolist()
-                temp.to_csv(os.path.join(ProjectPath, 'Step_4', 'ComputedPoints.csv'), index=False, mode='a', header=False, sep=',')
-            os.remove(os.path.join(ProjectPath,'Step_4','Temp',str(h+1)+'.csv'))
-        del temp
-        
-        #import all points to process
-        Pts_list=pd.read_csv(os.path.join(ProjectPath, 'Step_4', 'ComputedPoints.csv'), sep=',')
-        if Qgis.QGIS_VERSION_INT<31600:
-            Pts_list["Shadow1"]=Pts_list["Shadow_1"]
-        
-        #aggregate shadow information
-        pts_matrix=Pts_list.sort_values(by=["hour"]).groupby(by=["id"]).agg({'id':'first','x':'first','y':'first','Material':'first','alb': 'first', 'em': 'first', 'Cv': 'first', 'lambd': 'first', 'ep': 'first', 'kc': 'first', 'FixedTemp[degC]': 'first', 'Long': 'first','Lat': 'first','Shadow1':list})
-        pts_matrix['Shadow1'] = pts_matrix['Shadow1'].apply(lambda x: tuple(x))
-        pts_matrix['key']=pts_matrix.Material.astype(str)+'-'+pts_matrix.Shadow1.astype(str)
+        #aggregate shadow information, one row per point and one column per hour
+        pts_matrix=Pts_attributes.drop_duplicates(subset=["id"]).set_index("id", drop=False).sort_index().filter(items=['id','Material','alb','em','Cv','lambd','ep','kc','FixedTemp[degC]']).join(coordinates)
+        # Single precision is enough for the physical data (x and y are kept in double precision for the output)
+        float_columns=['alb','em','Cv','lambd','ep','kc','Long','Lat']
+        pts_matrix[float_columns]=pts_matrix[float_columns].astype('float32')
+        shadow_wide=shadow_wide[coordinates.index.get_indexer(pts_matrix.index)]
+        # Points sharing the same material and shadow values get the same integer key
+        row_hash=pd.util.hash_pandas_object(pd.DataFrame(shadow_wide, index=pts_matrix.index).assign(Material=pts_matrix["Material"]), index=False)
+        pts_matrix['key']=pd.factorize(row_hash)[0]
 
         feedback.pushInfo('')
         feedback.pushInfo('Simplification of the problem...')
         #Simplification of the problem
-        simplified=pts_matrix.groupby(by=["key"]).agg({'key':'first', 'id':'first','alb': 'first', 'em': 'first', 'Cv': 'first', 'lambd': 'first', 'ep': 'first', 'kc': 'first', 'FixedTemp[degC]': 'first', 'Long': 'first', 'Lat': 'first', 'Shadow1':'first'})
-
-        #import weather data
-        with open(str(parameters['weatherdataepw']), newline='') as csvfile:
-            csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            for i,row in enumerate(csvreader):
-                if row[0].isdigit():
-                    break
-        first_row=i # Get first row of epw file
+        first_rows=np.unique(pts_matrix['key'].to_numpy(), return_index=True)[1]
+        simplified=pts_matrix.iloc[first_rows].filter(items=['key','id','alb','em','Cv','lambd','ep','kc','FixedTemp[degC]','Long','Lat'])
+        simplified_shadow=shadow_wide[first_rows]
+
+        #import weather data, data of epw files always start after 8 header lines
         names=['Year', 'month','day', 'hour','Minute','Data Source and Uncertainty Flags','Dry Bulb Temperature [DegC]','Dew Point Temperature','Relative Humidity','Atmospheric Station Pressure','Extraterrestrial Horizontal Radiation','Extraterrestrial Direct Normal Radiation','Horizontal Infrared Radiation Intensity','Global Horizontal Radiation [Wh/m2]','Direct Normal Radiation','Diffuse Horizontal Radiation','Global Horizontal Illuminance','Direct Normal Illuminance','Diffuse Horizontal Illuminance','Zenith Luminance','Wind Direction','Wind Speed','Total Sky Cover','Opaque Sky Cover','Visibility','Ceiling Height','Present Weather Observation','Present Weather Codes','Precipitable Water','Aerosol Optical Depth','Snow Depth','Days Since Last Snowfall','Albedo','Liquid Precipitation Depth','Liquid Precipitation Quantity']
-        WeatherData=pd.read_csv(parameters['weatherdataepw'], skiprows=first_row, header=None, names=names)
+        usecols=['month','day','hour','Dry Bulb Temperature [DegC]','Global Horizontal Radiation [Wh/m2]','Relative Humidity']
+        dtype={'month':'int8','day':'int8','hour':'int8','Dry Bulb Temperature [DegC]':'float32','Global Horizontal Radiation [Wh/m2]':'float32','Relative Humidity':'float32'}
+        WeatherData=pd.read_csv(parameters['weatherdataepw'], skiprows=8, header=None, names=names, usecols=usecols, dtype=dtype)
 
         #Emprical Fuentes correlation (1987), to replace in future versions with better approximation
         WeatherData["Tsky"]=round((0.037536*(WeatherData["Dry Bulb Temperature [DegC]"]**1.5))+(0.32*WeatherData["Dry Bulb Temperature [DegC]"])+273.15,2)
 
-        #Add weather data to simplified problem
+        #Weather data of the day, hourly arrays of shape (24,) shared by all points
         WeatherData["Dry Bulb Temperature [DegC]"]=WeatherData["Dry Bulb Temperature [DegC]"]+273.15
-        AirTemp=tuple(WeatherData[(WeatherData["month"]==month) & (WeatherData["day"]==day)]["Dry Bulb Temperature [DegC]"])
-        simplified["Tair"]= [AirTemp] * len(simplified)
-        SolarRadiation=tuple(WeatherData[(WeatherData["month"]==month) & (WeatherData["day"]==day)]["Global Horizontal Radiation [Wh/m2]"])
-        simplified["Gh"]= [SolarRadiation] * len(simplified)
-        SkyTemp=tuple(WeatherData[(WeatherData["month"]==month) & (WeatherData["day"]==day)]["Tsky"])
-        simplified["Tsky"]= [SkyTemp] * len(simplified)
-        Humidity=tuple(WeatherData[(WeatherData["month"]==month) & (WeatherData["day"]==day)]["Relative Humidity"])
-        simplified["Ha"]=[Humidity]* len(simplified)
+        WeatherDay=WeatherData[(WeatherData["month"]==month) & (WeatherData["day"]==day)]
+        AirTemp=WeatherDay["Dry Bulb Temperature [DegC]"].to_numpy(dtype=np.float32)
+        SolarRadiation=WeatherDay["Global Horizontal Radiation [Wh/m2]"].to_numpy(dtype=np.float32)
+        SkyTemp=WeatherDay["Tsky"].to_numpy(dtype=np.float32)
+        Humidity=WeatherDay["Relative Humidity"].to_numpy(dtype=np.float32)
         
         #Function to solve the thermal problem
 
@@ -329,20 +305,12 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
         t=t+day
         
         # Annual Average Temperature (for each hour)
-        provisoire=[]
-        for i in range(1,25):
-            Temp_avg_hour=np.mean(tuple(WeatherData[(WeatherData["hour"]==i)]["Dry Bulb Temperature [DegC]"]))
-            provisoire.append(Temp_avg_hour)
-        Tyear=tuple(provisoire) 
-        simplified["Tyear"]=[Tyear]* len(simplified)
+        Tyear=WeatherData.groupby("hour")["Dry Bulb Temperature [DegC]"].mean().reindex(range(1,25)).to_numpy(dtype=np.float32)
               
         #Maximum annual temperature variation from average
-        provisoire2=[]
-        for i in provisoire:
-            deltaT_hour=max(max(WeatherData["Dry Bulb Temperature [DegC]"])-i,i-min(WeatherData["Dry Bulb Temperature [DegC]"]))
-            provisoire2.append(deltaT_hour)
-        deltaT=tuple(provisoire2)
-        simplified["deltaT"]=[deltaT]* len(simplified)
+        Tmax=WeatherData["Dry Bulb Temperature [DegC]"].max()
+        Tmin=WeatherData["Dry Bulb Temperature [DegC]"].min()
+        deltaT=np.maximum(Tmax-Tyear,Tyear-Tmin)
         
         # Thermal Diffusivity of Soil
         simplified["Dh"]=(simplified["lambd"]/simplified["Cv"])*86400
@@ -350,15 +318,13 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
         Z=0.2 #Depth of burial
         w=2*np.pi/365
 
-        def Tint(Tyear, deltaT, Dh): 
-            Tsol=[]
-            Zo= np.sqrt(2*Dh/w)
-            for i in range(0,24):
-                Tint=Tyear[i]-deltaT[i]*np.e**(-Z/Zo)*np.cos(w*t-Z/Zo)
-                Tsol.append(Tint)
-            return Tsol
-                   
-        simplified["Tint"]= simplified.apply(lambda row: Tint(row["Tyear"],row["deltaT"],row["Dh"]),axis=1)
+        # Tyear and deltaT are arrays of shape (24,), Dh an array of shape (N,)
+        # The annual wave only depends on the day of the year t, hours only differ through Tyear and deltaT
+        def Tint(Tyear, deltaT, Dh):
+            Zo= np.sqrt(2*Dh/w)[:,None]
+            return Tyear-deltaT*np.e**(-Z/Zo)*np.cos(w*t-Z/Zo)
+
+        Tsol=Tint(Tyear, deltaT, simplified["Dh"].to_numpy())
           
         #Evapotranspiration - Penman-Monteith method
   
@@ -378,64 +344,56 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
         dr=1+0.033*np.cos((2*np.pi/(365))*t) #Inverse relative distance Earth-Sun
         d=0.409*np.sin((2*np.pi/365)*t-1.39) #Solar declinaison
 
-        def Evapo(Tair,Gh,Ha, lat, alb ):
-            ETO=[]
-            th=[0.5,1.5,2.5,3.5,4.5,5.5,6.5,7.5,8.5,9.5,10.5,11.5,12.5,13.5,14.5,15.5,16.5,17.5,18.5,19.5,20.5,21.5,22.5,23.5]
-            phi=(np.pi/180)*lat # Conversion of latitude in degrees to radian
+        def Evapo(Tair, Gh, Ha, lat, alb):
+            # Weather data are arrays of shape (24,), lat and alb arrays of shape (N,), results are arrays of shape (N, 24)
+            th=np.arange(0.5,24) # Middle of each hour
+            phi=((np.pi/180)*lat)[:,None] # Conversion of latitude in degrees to radian
+            alb=alb[:,None]
             b=2*np.pi*(t-81)/364
             Sc= 0.1645*np.sin(2*b)-0.1255*np.cos(b)-0.025*np.sin(b)
-            for i in range(0,24):
-                Tmean=Tair[i]-273.3
-                Rs=Gh[i]*0.0036
-                Rns=(1-alb)*Rs
-                delta=4098*(0.6108*np.e**(17.27*Tmean/(Tmean+237.3)))/(Tmean+237.3)**2
-                DTjour=delta/(delta+gamma*(1+0.24*Vvent))
-                DTnuit=delta/(delta+gamma*(1+0.96*Vvent))
-                PTjour=gamma/(delta+gamma*(1+0.24*Vvent))
-                PTnuit=gamma/(delta+gamma*(1+0.96*Vvent))
-                TT=(37/(Tmean+273))*Vvent
-                
-                es=0.6108*np.e**((17.27*Tmean)/(Tmean+237.3)) 
-                Hum=Ha[i]
-                ea=es*(Hum/100)
-                
-                w=(np.pi/12)*((th[i]+0.06667*(l)+Sc)-12)
-                ws=np.arccos(-np.tan(phi)*np.tan(d))
-                w1=w-np.pi/24
-                w2=w+np.pi/24
-                if w>-ws and w<ws : #day/night difference
-        
-                    Ra=(12*(60)/np.pi)*0.0820*dr*((w2-w1)*np.sin(phi)*np.sin(d) + np.cos(phi)*np.cos(d)*(np.sin(w2)-np.sin(w1))) #extraterrestrial radiation
-                    Rso=(0.75+(2*10**(-5))*alt)*Ra #Clear sky solar radiation (Rso)
-                    Rnl=sigma_h*( (Tmean+273.16)**(4) ) * (0.34 - 0.14 * np.sqrt(ea))*(1.35*(Rs/Rso)-0.35)
-                    Rn=Rns-Rnl
-                    G=0.1*Rn
-                    Rng=0.408*Rn-G
-                    ETrad=DTjour*Rng
-                    ETwind=PTjour*TT*(es-ea)
-                else:
-                    Ra=0
-                    Rso=(0.75+(2*10**(-5))*alt)*Ra #Clear sky solar radiation (Rso)
-                    Rnl=sigma_h*( (Tmean+273.16)**(4) ) * (0.34 - 0.14 * np.sqrt(ea))*(1.35*0.8-0.35)
-                    Rn=Rns-Rnl
-                    G=0.5*Rn
-                    Rng=0.408*Rn-G
-                    ETrad=DTnuit*Rng
-                    ETwind=PTnuit*TT*(es-ea)
-                
-        
-                ET0=(ETwind+ETrad)*2260000/3600
-                if ET0<0:
-                        ET0=0
-                ETO.append(ET0)
-                 
-            return ETO
-        
-        simplified["ETO"]= simplified.apply(lambda row: Evapo(row["Tair"],row["Gh"],row["Ha"], row["Lat"], row["alb"]),axis=1)
+
+            Tmean=Tair-273.3
+            Rs=Gh*0.0036
+            Rns=(1-alb)*Rs
+            delta=4098*(0.6108*np.e**(17.27*Tmean/(Tmean+237.3)))/(Tmean+237.3)**2
+            DTjour=delta/(delta+gamma*(1+0.24*Vvent))
+            DTnuit=delta/(delta+gamma*(1+0.96*Vvent))
+            PTjour=gamma/(delta+gamma*(1+0.24*Vvent))
+            PTnuit=gamma/(delta+gamma*(1+0.96*Vvent))
+            TT=(37/(Tmean+273))*Vvent
+
+            es=0.6108*np.e**((17.27*Tmean)/(Tmean+237.3))
+            ea=es*(Ha/100)
+
+            w=(np.pi/12)*((th+0.06667*(l)+Sc)-12)
+            ws=np.arccos(-np.tan(phi)*np.tan(d))
+            w1=w-np.pi/24
+            w2=w+np.pi/24
+            day_mask=(w>-ws) & (w<ws) #day/night difference
+
+            Ra=np.where(day_mask, (12*(60)/np.pi)*0.0820*dr*((w2-w1)*np.sin(phi)*np.sin(d) + np.cos(phi)*np.cos(d)*(np.sin(w2)-np.sin(w1))), 0) #extraterrestrial radiation
+            Rso=(0.75+(2*10**(-5))*alt)*Ra #Clear sky solar radiation (Rso)
+            Rnl=sigma_h*( (Tmean+273.16)**(4) ) * (0.34 - 0.14 * np.sqrt(ea))*np.where(day_mask, 1.35*(Rs/np.where(day_mask, Rso, 1))-0.35, 1.35*0.8-0.35)
+            Rn=Rns-Rnl
+            G=np.where(day_mask, 0.1, 0.5)*Rn
+            Rng=0.408*Rn-G
+            ETrad=np.where(day_mask, DTjour, DTnuit)*Rng
+            ETwind=np.where(day_mask, PTjour, PTnuit)*TT*(es-ea)
+
+            return np.maximum(0, (ETwind+ETrad)*2260000/3600)
+
+        ETO=Evapo(AirTemp, SolarRadiation, Humidity, simplified["Lat"].to_numpy(), simplified["alb"].to_numpy())
 
         #thermal equilibrium equation
         def thermal_equation(x,A,B,C):
-            return A + (B * x) + ( C * ((x) ** 4) ) 
+            return A + (B * x) + ( C * ((x) ** 4) )
+
+        # Newton-Raphson on A + BT + CT^4 from the seed x, converges in a few iterations from the previous hour temperature
+        # Works on plain floats as well as on arrays of points
+        def solve_thermal_equation(A,B,C,x):
+            for i in range(6):
+                x = x - thermal_equation(x,A,B,C)/(B + 4*C*x*x*x)
+            return x
 
         # Depending on :
 
@@ -471,40 +429,49 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
 
         threshold = 0.5 # Calculation threshold, default = 0.5 degree Celsius
 
-        def compute_temp(id, FixedTemp, Shadow, B, C,  Gh, alb, em, Tsky, Tair, lambd, ep, Cv, ET0, Tint, kc):
-            Temp_DegC = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-            if not (FixedTemp==0):
-                for h in range(24):
-                    Temp_DegC[h]=FixedTemp
-            else:
-                T0=28+273.15 #initial guess temp at midnight
-                count=0
-                equilibrium=False
-                while equilibrium==False:
-                    for h in range(24):
-                        if h==0:
-                            A = compute_A(Shadow[h], Gh[h], alb, em, Tsky[h], Tair[h],lambd, ep, Cv, ET0[h], kc, Tint[h], T0)
-                            Temp_DegC[h] = optimize.root(thermal_equation, T0 - 0.5, (A, B, C)).x[0]
-                        else:
-                            A = compute_A(Shadow[h], Gh[h], alb, em, Tsky[h], Tair[h],lambd, ep, Cv, ET0[h], kc, Tint[h], Temp_DegC[h-1])
-                            if Shadow[h]>0.4:
-                                Temp_DegC[h] = optimize.root(thermal_equation, Temp_DegC[h-1] + 1.0, (A, B, C)).x[0]
-                            else:
-                                Temp_DegC[h] = optimize.root(thermal_equation, Temp_DegC[h-1] - 0.5, (A, B, C)).x[0]
-                    count += 1
-                    # At least 2 iterations, check convergence and stop after 25
-                    if count >= 2:
-                        error=abs(Temp_DegC[23]-T0)
-                        if error < threshold:
-                            equilibrium=True
-                        elif count==25:
-                            feedback.pushInfo('Equilibrium failed after 25 iterations for point :'+str(id))
-                            equilibrium=True
-                    T0=Temp_DegC[23]
-
+        def compute_temp(id, FixedTemp, Shadow, B, C, Gh, alb, em, Tsky, Tair, lambd, ep, Cv, ET0, Tint, kc):
+            # Points are solved all at once: per-point data are arrays of shape (N,), hourly data arrays of shape (N, 24),
+            # weather data (Gh, Tsky, Tair) arrays of shape (24,) shared by all points
+            # Hourly data are stored hour by hour (24, N) so that each hour of the loop reads contiguous memory, in single precision
+            Shadow, ET0, Tint = (np.ascontiguousarray(np.asarray(data, dtype=np.float32).T) for data in (Shadow, ET0, Tint))
+            Temp_DegC=np.zeros(Shadow.shape, dtype=np.float32)
+            T0=np.full(len(id), 28+273.15, dtype=np.float32) #initial guess temp at midnight
+            active=(FixedTemp==0) # Points still looking for equilibrium
+            missing=np.zeros(len(id), dtype=bool) # Points with missing input data for at least one hour
+            count=0
+            while active.any():
+                # Only points which are not at equilibrium yet are solved again
+                p=np.flatnonzero(active)
+                p_alb, p_em, p_Cv, p_lambd, p_ep, p_kc, p_B, p_C = alb[p], em[p], Cv[p], lambd[p], ep[p], kc[p], B[p], C[p]
                 for h in range(24):
-                    Temp_DegC[h] = round(Temp_DegC[h]-273.15,2)
-            return Temp_DegC
+                    if h==0:
+                        A = compute_A(Shadow[h,p], Gh[h], p_alb, p_em, Tsky[h], Tair[h], p_lambd, p_ep, p_Cv, ET0[h,p], p_kc, Tint[h,p], T0[p])
+                        x = T0[p] - 0.5
+                    else:
+                        T_prev = Temp_DegC[h-1,p]
+                        A = compute_A(Shadow[h,p], Gh[h], p_alb, p_em, Tsky[h], Tair[h], p_lambd, p_ep, p_Cv, ET0[h,p], p_kc, Tint[h,p], T_prev)
+                        x = np.where(Shadow[h,p]>0.4, T_prev + 1.0, T_prev - 0.5)
+                    # Missing input data (NaN shadow outside of the rasters, weather or material values) give no solution,
+                    # the seed is kept so that NaN does not spread to the next hours and days
+                    x_solved = solve_thermal_equation(A, p_B, p_C, x)
+                    invalid = ~np.isfinite(x_solved)
+                    missing[p[invalid]] = True
+                    Temp_DegC[h,p] = np.where(invalid, x, x_solved)
+                count += 1
+                # At least 2 iterations, check convergence and stop after 25
+                if count >= 2:
+                    error=np.abs(Temp_DegC[23]-T0)
+                    if count==25:
+                        for point in id[active & ~(error < threshold)]:
+                            feedback.pushInfo('Equilibrium failed after 25 iterations for point :'+str(point))
+                        break
+                    active = active & ~(error < threshold)
+                T0=Temp_DegC[23].copy()
+
+            for point in id[missing]:
+                feedback.pushInfo('Missing input data for point :'+str(point)+', initial guess kept for the hours concerned')
+
+            return np.where((FixedTemp==0)[:,None], np.round(Temp_DegC.T.astype(np.float64)-273.15,2), FixedTemp[:,None])
 
         feedback.setCurrentStep(5)
         if feedback.isCanceled():
@@ -512,14 +479,24 @@ class ComputeGroundTemperatureEPW(QgsProcessingAlgorithm):
 
         feedback.pushInfo('')
         feedback.pushInfo('Calculation of the temperatures of all points for each hour...')
-        #Apply function to the simplified problem(parallelized)
-        simplified["Temp_DegC"]= simplified.apply(lambda row: compute_temp(row["id"],row["FixedTemp[degC]"],row["Shadow1"],row["B"],row["C"], row["Gh"],row["alb"],row["em"],row["Tsky"],row["Tair"],row["lambd"],row["ep"], row["Cv"],row["ETO"],row["Tint"],row["kc"]),axis=1)
-        simplified["min_DegC"]=simplified["Temp_DegC"].apply(min)
-        simplified["mean_DegC"]=round(simplified["Temp_DegC"].apply(statistics.mean),2)
-        simplified["max_DegC"]=simplified["Temp_DegC"].apply(max)
-
-        output=pts_matrix.merge(simplified.set_index('id').filter(items=['key','Temp_DegC','min_DegC','mean_DegC','max_DegC']), how='left', on='key').filter(items=['id','x','y','Temp_DegC','min_DegC','mean_DegC','max_DegC'])
-        output.to_csv(os.path.join(ProjectPath, 'Step_4', 'ComputedPoints.csv'),index=False, mode='w', header=True, sep=',')
+        #Solve the simplified problem for all points at once, temperatures are kept as an array of shape (K, 24) rather than as lists in the table
+        Temp_DegC=compute_temp(simplified["id"].to_numpy(), simplified["FixedTemp[degC]"].to_numpy(), simplified_shadow, simplified["B"].to_numpy(), simplified["C"].to_numpy(),
+                                               SolarRadiation, simplified["alb"].to_numpy(), simplified["em"].to_numpy(), SkyTemp, AirTemp,
+                                               simplified["lambd"].to_numpy(), simplified["ep"].to_numpy(), simplified["Cv"].to_numpy(), ETO, Tsol, simplified["kc"].to_numpy())
+        simplified["min_DegC"]=Temp_DegC.min(axis=1)
+        simplified["mean_DegC"]=np.round(Temp_DegC.mean(axis=1),2)
+        simplified["max_DegC"]=Temp_DegC.max(axis=1)
+
+        #Give each point the results of its key in the simplified problem
+        output=pts_matrix.filter(items=['id','x','y'])
+        # Row of each point key in the simplified problem
+        rows=pd.Index(simplified['key']).get_indexer(pts_matrix['key'])
+        # Hourly temperatures are written as one numeric column per hour (T_01 to T_24) rather than as a list
+        hourly_columns=['T_%02d' % (h+1) for h in range(24)]
+        output[hourly_columns]=pd.DataFrame(Temp_DegC[rows], index=output.index, columns=hourly_columns)
+        for column in ['min_DegC','mean_DegC','max_DegC']:
+            output[column]=simplified[column].to_numpy()[rows]
+        output.to_csv(os.path.join(ProjectPath, 'Step_4', 'ComputedPoints.csv'),index=False, mode='w', header=True, sep=',', chunksize=65536)
 
         uri = 'file:///'+os.path.join(ProjectPath, 'Step_4', 'ComputedPoints.csv')+'?delimiter=,&xField=x&yField=y&crs='+SCR+'&spatialIndex=yes'
         result_layer=QgsVectorLayer(uri,"ground_points","delimitedtext")